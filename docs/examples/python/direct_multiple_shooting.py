@@ -22,6 +22,8 @@
 #
 #
 from casadi import *
+import numpy as np
+import os
 
 T = 10. # Time horizon
 N = 20 # number of control intervals
@@ -38,90 +40,207 @@ xdot = vertcat((1-x2**2)*x1 - x2 + u, x1)
 # Objective term
 L = x1**2 + x2**2 + u**2
 
-# Formulate discrete time dynamics
-if False:
-   # CVODES from the SUNDIALS suite
-   dae = {'x':x, 'p':u, 'ode':xdot, 'quad':L}
-   opts = {'tf':T/N}
-   F = integrator('F', 'cvodes', dae, opts)
-else:
-   # Fixed step Runge-Kutta 4 integrator
-   M = 4 # RK4 steps per interval
-   DT = T/N/M
-   f = Function('f', [x, u], [xdot, L])
-   X0 = MX.sym('X0', 2)
-   U = MX.sym('U')
-   X = X0
-   Q = 0
-   for j in range(M):
-       k1, k1_q = f(X, U)
-       k2, k2_q = f(X + DT/2 * k1, U)
-       k3, k3_q = f(X + DT/2 * k2, U)
-       k4, k4_q = f(X + DT * k3, U)
-       X=X+DT/6*(k1 +2*k2 +2*k3 +k4)
-       Q = Q + DT/6*(k1_q + 2*k2_q + 2*k3_q + k4_q)
-   F = Function('F', [X0, U], [X, Q],['x0','p'],['xf','qf'])
+# Formulate discrete time dynamics with a fixed step Runge-Kutta 4 integrator
+M = 4 # RK4 steps per interval
+# Augment the state with the quadrature state, so that a single RK4 sweep
+# propagates both through one accumulator. The augmented derivative is
+# [xdot; L]; the quadrature state does not enter the dynamics.
+# Expand to an SX function so that the RK4 loop below unrolls into a flat
+# scalar expression graph rather than a chain of embedded function calls
+q = MX.sym('q')
+fa = Function('fa', [vertcat(x, q), u], [vertcat(xdot, L)]).expand()
+# A single RK4 step as a reusable kernel. The step size is an input rather
+# than a baked-in constant, so the horizon can change without rebuilding
+# (and recompiling) any of the symbolic graphs
+XQ = SX.sym('xq', 3)
+V = SX.sym('v')
+H = SX.sym('h')
+# Hoist the RK4 coefficients out of the step
+H2 = H/2
+H6 = H/6
+k1 = fa(XQ, V)
+k2 = fa(XQ + H2 * k1, V)
+k3 = fa(XQ + H2 * k2, V)
+k4 = fa(XQ + H * k3, V)
+rk4_step = Function('rk4_step', [XQ, V, H],
+                    [XQ + H6*(k1 + (k2+k2) + (k3+k3) + k4)])
+# Chain M steps by accumulation: the step kernel is stored once and
+# referenced M times, instead of unrolling M copies of its graph
+rk4_M = rk4_step.mapaccum('rk4_M', M)
+X0 = MX.sym('X0', 2)
+U = MX.sym('U')
+DT = MX.sym('dt')
+XQf = rk4_M(vertcat(X0, 0), repmat(U, 1, M), repmat(DT, 1, M))[:, -1]
+F = Function('F', [X0, U, DT], [XQf[:2], XQf[2]], ['x0','p','dt'],['xf','qf'])
 
 # Evaluate at a test point
-Fk = F(x0=[0.2,0.3],p=0.4)
+Fk = F(x0=[0.2,0.3],p=0.4,dt=T/N/M)
 print(Fk['xf'])
 print(Fk['qf'])
 
-# Start with an empty NLP
-w=[]
-w0 = []
-lbw = []
-ubw = []
-J = 0
-g=[]
-lbg = []
-ubg = []
-
-# "Lift" initial conditions
-Xk = MX.sym('X0', 2)
-w += [Xk]
-lbw += [0, 1]
-ubw += [0, 1]
-w0 += [0, 1]
-
-# Formulate the NLP
-for k in range(N):
-    # New NLP variable for the control
-    Uk = MX.sym('U_' + str(k))
-    w   += [Uk]
-    lbw += [-1]
-    ubw += [1]
-    w0  += [0]
-
-    # Integrate till the end of the interval
-    Fk = F(x0=Xk, p=Uk)
-    Xk_end = Fk['xf']
-    J=J+Fk['qf']
-
-    # New NLP variable for state at end of interval
-    Xk = MX.sym('X_' + str(k+1), 2)
-    w   += [Xk]
-    lbw += [-0.25, -inf]
-    ubw += [  inf,  inf]
-    w0  += [0, 0]
-
-    # Add equality constraint
-    g   += [Xk_end-Xk]
-    lbg += [0, 0]
-    ubg += [0, 0]
-
-# Create an NLP solver
-prob = {'f': J, 'x': vertcat(*w), 'g': vertcat(*g)}
-solver = nlpsol('solver', 'ipopt', prob);
+# Total number of NLP variables: N+1 states, N controls
+nv = 2*(N+1) + N
+
+# One symbolic vector holds all decision variables, packed interleaved per
+# interval as [x_k; u_k] with the terminal state last, matching the
+# stride-based extraction of the solution below. The state and control
+# matrices are cheap slices of this single graph leaf, instead of N+1
+# per-interval symbols tied together with concatenations
+w = MX.sym('w', nv)
+WU = reshape(w[:3*N], 3, N)
+X_mat = horzcat(WU[:2, :], w[3*N:])
+U_mat = WU[2, :]
+
+# Index arrays into the packed variable vector, computed once and shared
+# between the bounds fill here and the solution extraction below
+ix1 = np.arange(0, nv, 3)  # x1_k
+ix2 = np.arange(1, nv, 3)  # x2_k
+iu = np.arange(2, nv, 3)   # u_k
+
+# Preallocate the bounds and initial guess, filled by strided assignment
+w0 = np.zeros(nv)
+lbw = np.zeros(nv)
+ubw = np.zeros(nv)
+
+# The initial state and the horizon length enter as parameters: the first
+# state variables stay free in the bounds and are tied to P[0:2] by an
+# equality constraint below, and the step size is derived from P[2]. The
+# NLP is built and compiled once and reused for any (x_init, T) scenario
+P = MX.sym('P', 3)
+x_init = [0, 1]
+lbw[0:2] = -inf
+ubw[0:2] = inf
+w0[0:2] = x_init
+
+# Control bounds
+lbw[iu] = -1
+ubw[iu] = 1
+
+# State bounds: x1 bounded from below, x2 free
+lbw[ix1[1:]] = -0.25
+ubw[ix1[1:]] = inf
+lbw[ix2[1:]] = -inf
+ubw[ix2[1:]] = inf
+
+# Integrate all N intervals with a single map call; the intervals are
+# independent and evaluate in parallel threads
+F_map = F.map(N, 'openmp')
+dt_sym = P[2]/(N*M)
+Xf, Qf = F_map(X_mat[:, :N], U_mat, repmat(dt_sym, 1, N))
+
+# Objective: sum of the interval quadratures
+J = sum2(Qf)
+
+# All equality constraints in one expression: the initial condition plus
+# the continuity defects of every interval. The defects are a single
+# elementwise subtraction whose Jacobian blocks form a clean (-I, +I)
+# identity pattern next to the integrator sensitivities
+g = vertcat(X_mat[:, 0] - P[0:2], vec(Xf - X_mat[:, 1:]))
+lbg = np.zeros(2*(N+1))
+ubg = np.zeros(2*(N+1))
+
+# The constraint Jacobian of a multiple-shooting NLP is block-banded: each
+# defect involves only (x_k, u_k, x_{k+1}). The map-based constraints keep
+# that structure in the graph, so sparsity detection and AD work on the
+# O(N) band instead of probing a dense matrix
+jac_g = jacobian(g, w)
+print('constraint Jacobian: %d-by-%d with %d structural nonzeros (dense: %d)'
+      % (jac_g.size1(), jac_g.size2(), jac_g.nnz(), jac_g.numel()))
+
+# Note on common subexpressions: the objective and the defects both hang
+# off the single mapped integrator call, which the DAG stores and
+# evaluates once. The expanded step kernel, the mapaccum step chain and
+# the mapped intervals leave no duplicated subtrees to eliminate
+
+# Create an NLP solver, JIT compiling the NLP functions to native code so
+# that IPOPT evaluates compiled kernels instead of the virtual machine
+prob = {'f': J, 'x': w, 'g': g, 'p': P}
+# The mapped integrator is emitted as an OpenMP-parallel loop in the
+# generated C, so compiling with -fopenmp keeps the multi-core evaluation;
+# the flag must also be passed at the link step to pull in the OpenMP
+# runtime. -march=native is fine here since the JIT output never leaves
+# this machine
+opts = {'jit': True, 'compiler': 'shell',
+        'jit_options': {'flags': ['-O3', '-march=native', '-fopenmp'],
+                        'linker_flags': ['-fopenmp'],
+                        'verbose': False},
+        # Bias the AD mode choice towards reverse mode for the NLP functions:
+        # there are many more decision variables than outputs, so adjoint
+        # sweeps are the cheaper way to get the gradient and Jacobian.
+        # final_options applies at function construction, after the
+        # expressions have been generated
+        'common_options': {'final_options': {'ad_weight': 1,
+                                             'ad_weight_sp': 1}},
+        # Let IPOPT use the supplied primal-dual guess on repeated solves
+        'ipopt': {'warm_start_init_point': 'yes'}}
+
+# Constructing and JIT compiling the solver dominates the setup time, so
+# cache the initialized solver on disk and reload it on subsequent runs.
+# The cache is keyed on the filename only: after editing the problem
+# structure (N, bounds layout) or the solver options, delete the file or
+# the stale compiled solver keeps being served
+cache = 'direct_multiple_shooting_solver.casadi'
+if os.path.exists(cache):
+    solver = Function.load(cache)
+else:
+    solver = nlpsol('solver', 'ipopt', prob, opts)
+    solver.save(cache)
+
+# Convert the numpy buffers to DM up front: DM storage is one contiguous
+# dense block, so this is a single packed copy each, and the repeated
+# solver calls below reuse them without converting again
+w0 = DM(w0)
+lbw = DM(lbw)
+ubw = DM(ubw)
+lbg = DM(lbg)
+ubg = DM(ubg)
 
 # Solve the NLP
-sol = solver(x0=w0, lbx=lbw, ubx=ubw, lbg=lbg, ubg=ubg)
+sol = solver(x0=w0, lbx=lbw, ubx=ubw, lbg=lbg, ubg=ubg, p=x_init + [T])
+
+# Solve again, warm started from the first solution: IPOPT now converges
+# in a handful of iterations, the pattern to use for repeated solves
+sol = solver(x0=sol['x'], lam_x0=sol['lam_x'], lam_g0=sol['lam_g'],
+             lbx=lbw, ubx=ubw, lbg=lbg, ubg=ubg, p=x_init + [T])
 w_opt = sol['x'].full().flatten()
 
-# Plot the solution
-x1_opt = w_opt[0::3]
-x2_opt = w_opt[1::3]
-u_opt = w_opt[2::3]
+# Parametric sensitivity of the solution: an NLP solver object is
+# differentiable, and its Jacobian follows from the implicit function
+# theorem at the KKT fixed point -- one linear solve with the factored
+# KKT matrix, not AD through the solver iterations. Differentiating
+# needs exact multipliers and differentiable oracle functions, so refine
+# the IPOPT solution with an SQP solver using an active-set QP and
+# differentiate that, the same pattern as nlp_sensitivities.py
+sopts = {'qpsol': 'qrqp',
+         'qpsol_options': {'print_iter': False, 'error_on_fail': False},
+         'print_time': False}
+ssolver = nlpsol('ssolver', 'sqpmethod', prob, sopts)
+# Warm start the primal point only: passing IPOPT's interior-point
+# multipliers along would satisfy the convergence check before any QP is
+# solved, leaving the inexact multipliers in place for the derivative
+ssol = ssolver(x0=sol['x'],
+               lbx=lbw, ubx=ubw, lbg=lbg, ubg=ubg, p=x_init + [T])
+jsolver = ssolver.factory('jsolver', ssolver.name_in(), ['jac:x:p'])
+jsol = jsolver(x0=ssol['x'], lam_x0=ssol['lam_x'], lam_g0=ssol['lam_g'],
+               lbx=lbw, ubx=ubw, lbg=lbg, ubg=ubg, p=x_init + [T])
+print('sensitivity of the terminal state to the initial state:')
+print(jsol['jac_x_p'][-2:, :2])
+
+# Plot the solution, reusing the precomputed index arrays
+x1_opt = w_opt[ix1]
+x2_opt = w_opt[ix2]
+u_opt = w_opt[iu]
+
+# The integrator also vectorizes over an ensemble axis: simulating a batch
+# of perturbed initial states under the optimal controls is one parallel
+# map call over the step chain, not a Python loop over scenarios
+n_ens = 8
+sim = F.mapaccum('sim', N).map(n_ens, 'openmp')
+x0_ens = np.vstack((np.linspace(-0.05, 0.05, n_ens), np.ones(n_ens)))
+X_ens = sim(x0_ens, np.tile(u_opt, (1, n_ens)),
+            np.full((1, N*n_ens), T/N/M))[0].full()
+print('terminal states over the ensemble:')
+print(X_ens[:, N-1::N])
 
 tgrid = [T/N*k for k in range(N+1)]
 import matplotlib.pyplot as plt
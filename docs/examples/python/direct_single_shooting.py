@@ -22,6 +22,7 @@
 #
 #
 from casadi import *
+import numpy as np
 
 T = 10. # Time horizon
 N = 20 # number of control intervals
@@ -67,52 +68,41 @@ Fk = F(x0=[0.2,0.3],p=0.4)
 print(Fk['xf'])
 print(Fk['qf'])
 
-# Start with an empty NLP
-w=[]
-w0 = []
-lbw = []
-ubw = []
-J = 0
-g=[]
-lbg = []
-ubg = []
+# NLP variables: one control per interval
+U = MX.sym('U', 1, N)
+w = vec(U)
+lbw = [-1]*N
+ubw = [1]*N
+w0 = [0]*N
 
-# Formulate the NLP
-Xk = MX([0, 1])
-for k in range(N):
-    # New NLP variable for the control
-    Uk = MX.sym('U_' + str(k))
-    w += [Uk]
-    lbw += [-1]
-    ubw += [1]
-    w0 += [0]
+# Propagate the state through all N intervals with a single mapaccum call,
+# instead of calling F interval by interval in a Python loop
+F_N = F.mapaccum('F_N', N)
+res = F_N(x0=[0, 1], p=U)
+Xs = res['xf']
 
-    # Integrate till the end of the interval
-    Fk = F(x0=Xk, p=Uk)
-    Xk = Fk['xf']
-    J=J+Fk['qf']
+# Objective: sum of the interval quadratures
+J = sum2(res['qf'])
 
-    # Add inequality constraint
-    g += [Xk[0]]
-    lbg += [-.25]
-    ubg += [inf]
+# Path constraint on the first state, all intervals at once
+g = Xs[0, :].T
+lbg = [-.25]*N
+ubg = [inf]*N
 
 # Create an NLP solver
-prob = {'f': J, 'x': vertcat(*w), 'g': vertcat(*g)}
+prob = {'f': J, 'x': w, 'g': g}
 solver = nlpsol('solver', 'ipopt', prob)
 
 # Solve the NLP
 sol = solver(x0=w0, lbx=lbw, ubx=ubw, lbg=lbg, ubg=ubg)
-w_opt = sol['x']
+u_opt = sol['x'].full().flatten()
 
-# Plot the solution
-u_opt = w_opt
-x_opt = [[0, 1]]
-for k in range(N):
-    Fk = F(x0=x_opt[-1], p=u_opt[k])
-    x_opt += [Fk['xf'].full()]
-x1_opt = [r[0] for r in x_opt]
-x2_opt = [r[1] for r in x_opt]
+# Recover the optimal state trajectory with the same mapaccum chain and
+# read it out with numpy slices instead of element-wise indexing
+x_opt = F_N(x0=[0, 1], p=u_opt.reshape(1, N))['xf'].full()
+x_opt = np.hstack((np.array([[0], [1]]), x_opt))
+x1_opt = x_opt[0, :]
+x2_opt = x_opt[1, :]
 
 tgrid = [T/N*k for k in range(N+1)]
 import matplotlib.pyplot as plt
@@ -120,7 +110,7 @@ plt.figure(1)
 plt.clf()
 plt.plot(tgrid, x1_opt, '--')
 plt.plot(tgrid, x2_opt, '-')
-plt.step(tgrid, vertcat(DM.nan(1), u_opt), '-.')
+plt.step(tgrid, np.append(np.nan, u_opt), '-.')
 plt.xlabel('t')
 plt.legend(['x1','x2','u'])
 plt.grid()